@@ -1,4 +1,6 @@
 # Python Version: 3.x
+import collections
+import concurrent.futures
 import functools
 import os
 import pathlib
@@ -91,10 +93,42 @@ c_standard_libraries = [
     'wctype.h',
 ]
 
-standard_libraries = set([bits_stdcxx_h] + cxx_standard_libraries + c_standard_libraries + ['c' + name[:-len('.h')] for name in c_standard_libraries])
-
-
-@functools.lru_cache(maxsize=None)
+standard_libraries: FrozenSet[str] = frozenset([bits_stdcxx_h] + cxx_standard_libraries + c_standard_libraries + ['c' + name[:-len('.h')] for name in c_standard_libraries])
+
+# directive の種類. 行ごとに正規表現をいくつも試すのは遅いので、名前を読んで dict で引く
+_DIRECTIVE_NAMES = {
+    b'if': 'if',
+    b'ifdef': 'ifdef',
+    b'ifndef': 'ifndef',
+    b'else': 'else',
+    b'elif': 'elif',
+    b'endif': 'endif',
+    b'pragma': 'pragma',
+    b'define': 'define',
+    b'include': 'include',
+}
+
+RE_DIRECTIVE = re.compile(rb'\s*#\s*(\w*)')
+# 以下は classify が返す directive の残りの部分に使う
+RE_PRAGMA_ONCE_ARGUMENT = re.compile(rb'\s+once')
+RE_MACRO_ARGUMENT = re.compile(rb'\s+(\w+)')
+RE_INCLUDE_ARGUMENT = re.compile(rb'\s*(?:<(?P<system>.*)>|"(?P<user>.*)")')
+# 行に分割する前のコード全体から #include "..." を探すためのもの
+RE_INCLUDE_USER_MULTILINE = re.compile(rb'^[^\S\n]*#[^\S\n]*include[^\S\n]*"(.*)"', re.MULTILINE)
+
+
+def classify(line: bytes) -> Tuple[Optional[str], memoryview]:
+    """
+    :returns: the name of the directive (e.g. :code:`'include'`) and the rest of the line. The name is :any:`None` if the line is not a directive which :class:`Bundler` handles.
+    """
+
+    matched = RE_DIRECTIVE.match(line)
+    if matched is None:
+        return None, memoryview(b'')
+    return _DIRECTIVE_NAMES.get(matched.group(1)), memoryview(line)[matched.end():]
+
+
+@functools.lru_cache(maxsize=8)
 def _check_compiler(compiler: str) -> str:
     # Executables named "g++" are not always g++, due to the fake g++ of macOS
     version = subprocess.check_output([compiler, '--version']).decode()
@@ -105,35 +139,205 @@ def _check_compiler(compiler: str) -> str:
     return 'unknown'  # default
 
 
-@functools.lru_cache(maxsize=None)
-def _get_uncommented_code(path: pathlib.Path, *, iquotes_options: Tuple[str, ...], compiler: str) -> bytes:
-    # `iquotes_options` must be a tuple to use `lru_cache`
+# C++ のコメントを取り除くための字句
+# 文字列リテラルなどの中の // や /* をコメントと誤認しないように、それらも 1 つの字句として読み飛ばす
+_RE_COMMENT_OR_LITERAL = re.compile(rb"""
+    (?P<line_comment>//[^\n]*)
+    |(?P<block_comment>/\*.*?\*/)
+    |(?P<raw_string>(?<!\w)(?:u8|u|U|L)?R"(?P<delimiter>[^\s()\\]{0,16})\(.*?\)(?P=delimiter)")
+    |(?P<number>(?<![\w.])\.?[0-9](?:[eEpP][+-]|'\w|[\w.])*)
+    |(?P<string>"(?:\\[^\n]|[^"\\\n])*")
+    |(?P<char>'(?:\\[^\n]|[^'\\\n])*')
+    |(?P<unsupported>/\*|["'])
+    """, re.DOTALL | re.VERBOSE)
+
+
+def _replace_comment(matched: Match[bytes]) -> bytes:
+    if matched.lastgroup == 'unsupported':
+        raise BundleError('unterminated comment or literal found')
+    if matched.lastgroup == 'line_comment':
+        return b''
+    if matched.lastgroup == 'block_comment':
+        # 行番号がずれないように改行は残す
+        return b'\n' * matched.group().count(b'\n') or b' '
+    return matched.group()
+
+
+def strip_comments(code: bytes) -> bytes:
+    """
+    :raises BundleError: if the code has something which this function doesn't understand, e.g. unterminated literals or line splices in literals
+    """
+
+    return _RE_COMMENT_OR_LITERAL.sub(_replace_comment, code)
+
+
+# _get_uncommented_code の結果. _preprocess_many_files からまとめて埋めるので lru_cache ではなく OrderedDict で LRU を実装する
+# 中身はファイルの内容ほぼそのままなので、oj-verify を長く動かし続けてもメモリを使いすぎないように大きさを制限する
+_UNCOMMENTED_CODE_CACHE_SIZE = 1024
+_uncommented_code_cache = collections.OrderedDict()  # type: collections.OrderedDict[Tuple[pathlib.Path, Tuple[str, ...], str], bytes]
+
+
+def _store_uncommented_code(path: pathlib.Path, code: bytes, *, iquotes_options: Tuple[str, ...], compiler: str) -> None:
+    key = (path, iquotes_options, compiler)
+    _uncommented_code_cache[key] = code
+    _uncommented_code_cache.move_to_end(key)
+    while len(_uncommented_code_cache) > _UNCOMMENTED_CODE_CACHE_SIZE:
+        _uncommented_code_cache.popitem(last=False)
+
+
+# ファイルの変更を監視して何度も bundle するようなツールのためのもの
+def clear_caches() -> None:
+    _check_compiler.cache_clear()
+    _ensure_gcc.cache_clear()
+    _uncommented_code_cache.clear()
 
+
+@functools.lru_cache(maxsize=8)
+def _ensure_gcc(compiler: str) -> None:
     if shutil.which(compiler) is None:
         raise BundleError(f'command not found: {compiler}')
     if _check_compiler(compiler) != 'gcc':
         if compiler == 'g++':
             raise BundleError(f'A fake g++ is detected. Please install the GNU C++ compiler.: {compiler}')
         raise BundleError(f"It's not g++. Please specify g++ with $CXX envvar.: {compiler}")
-    command = [compiler, *iquotes_options, '-fpreprocessed', '-dD', '-E', str(path)]
-    return subprocess.check_output(command)
 
 
-def get_uncommented_code(path: pathlib.Path, *, iquotes: List[pathlib.Path], compiler: str) -> bytes:
+# g++ の出力の `# 1 "foo.hpp"` のような行を消し、その代わりに行番号が合うように空行を入れる
+# -fpreprocessed なので #include は展開されず、marker は常にそのファイル自身を指す. include の関係は読み取れないので flag も見ない
+def _remove_line_markers(code: bytes) -> bytes:
+    result = bytearray()
+    lineno = 1  # 次に書く行の行番号
+    for line in code.splitlines(keepends=True):
+        # ほとんどの行は 2 文字見れば違うと分かるので、正規表現は使わずに読む
+        if line.startswith(b'# '):
+            j = 2
+            while j < len(line) and 0x30 <= line[j] <= 0x39:
+                j += 1
+            if j > 2 and line[j:j + 2] == b' "' and line.find(b'"', j + 2) != -1:
+                marker_lineno = int(line[2:j])
+                if lineno < marker_lineno:
+                    result += b'\n' * (marker_lineno - lineno)
+                    lineno = marker_lineno
+                continue
+        result += line
+        lineno += 1
+    return bytes(result)
+
+
+def _get_uncommented_code(path: pathlib.Path, *, iquotes_options: Tuple[str, ...], compiler: str) -> bytes:
+    key = (path, iquotes_options, compiler)
+    if key not in _uncommented_code_cache:
+        _preprocess_many_files([path], iquotes_options=iquotes_options, compiler=compiler)
+    else:
+        _uncommented_code_cache.move_to_end(key)
+    return _uncommented_code_cache[key]
+
+
+# g++ を 1 回だけ起動して複数のファイルをまとめて処理する. 失敗した場合は空の dict を返す
+def _run_gcc_at_once(paths: List[pathlib.Path], *, iquotes_options: Tuple[str, ...], compiler: str) -> Dict[pathlib.Path, bytes]:
+    command = [compiler, *iquotes_options, '-fpreprocessed', '-dD', '-E', *map(str, paths)]
+    try:
+        code = subprocess.check_output(command)
+    except subprocess.CalledProcessError:
+        # ファイルごとに g++ を呼んだときにエラーを報告させる
+        logger.debug('failed to preprocess files at once: %s', ' '.join(command))
+        return {}
+
+    # 出力は各ファイルの結果を順に連結したもので、それぞれ `# 1 "path"` の行から始まる
+    # path の中の \ と " は cpp によって escape される
+    starts = []  # type: List[int]
+    for path in paths:
+        marker = b'# 1 "' + os.fsencode(str(path)).replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"\n'
+        start = code.find(marker, starts[-1] + 1 if starts else 0)
+        if start == -1 or (start != 0 and code[start - 1:start] != b'\n'):
+            logger.debug('failed to split the output of g++: %s', str(path))
+            return {}
+        starts.append(start)
+    starts.append(len(code))
+    return {path: _remove_line_markers(code[start:end]) for path, start, end in zip(paths, starts, starts[1:])}
+
+
+_GCC_FILES_PER_JOB = 8
+
+
+# ほとんどのファイルは strip_comments で処理し、それで処理できないファイルだけ g++ に通して、_get_uncommented_code の cache を埋めておく
+# g++ を使うときは、ファイルたちをいくつかに分けてまとめ、それぞれ 1 回ずつ並列に g++ を起動する
+def _preprocess_many_files(paths: List[pathlib.Path], *, iquotes_options: Tuple[str, ...], compiler: str) -> None:
+    paths = [path for path in dict.fromkeys(paths) if (path, iquotes_options, compiler) not in _uncommented_code_cache]
+    if not paths:
+        return
+    # g++ を使わずに済む場合でも、bundle した結果は g++ で使われることを前提にしているので、先に確認しておく
+    _ensure_gcc(compiler)
+
+    paths_for_gcc = []
+    for path in paths:
+        with open(str(path), 'rb') as fh:
+            code = fh.read()
+        try:
+            uncommented = strip_comments(code)
+        except BundleError as e:
+            logger.debug('%s: use g++ to remove comments: %s', str(path), e)
+            paths_for_gcc.append(path)
+            continue
+        # g++ は末尾の空行を出力しないので、それに合わせる
+        uncommented = uncommented.rstrip()
+        _store_uncommented_code(path, uncommented + b'\n' if uncommented else b'', iquotes_options=iquotes_options, compiler=compiler)
+
+    results = {}  # type: Dict[pathlib.Path, bytes]
+    if len(paths_for_gcc) >= 2:
+        # g++ の起動は重いので、1 回の g++ には少なくとも _GCC_FILES_PER_JOB 個のファイルを渡す
+        jobs = max(1, min(os.cpu_count() or 1, len(paths_for_gcc) // _GCC_FILES_PER_JOB))
+        chunks = [paths_for_gcc[i::jobs] for i in range(jobs)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for result in executor.map(lambda chunk: _run_gcc_at_once(chunk, iquotes_options=iquotes_options, compiler=compiler), chunks):
+                results.update(result)
+
+    for path in paths_for_gcc:
+        if path not in results:
+            command = [compiler, *iquotes_options, '-fpreprocessed', '-dD', '-E', str(path)]
+            results[path] = _remove_line_markers(subprocess.check_output(command))
+        _store_uncommented_code(path, results[path], iquotes_options=iquotes_options, compiler=compiler)
+
+
+# iquotes は解決済みの path であること
+def _get_iquotes_options(iquotes: List[pathlib.Path]) -> Tuple[str, ...]:
     iquotes_options = []
     for iquote in iquotes:
-        iquotes_options.extend(['-I', str(iquote.resolve())])
-    code = _get_uncommented_code(path.resolve(), iquotes_options=tuple(iquotes_options), compiler=compiler)
-    lines = []  # type: List[bytes]
-    for line in code.splitlines(keepends=True):
-        m = re.match(rb'# (\d+) ".*"', line.rstrip())
-        if m:
-            lineno = int(m.group(1))
-            while len(lines) + 1 < lineno:
-                lines.append(b'\n')
-        else:
-            lines.append(line)
-    return b''.join(lines)
+        iquotes_options.extend(['-I', str(iquote)])
+    return tuple(iquotes_options)
+
+
+def get_uncommented_code(path: pathlib.Path, *, iquotes: List[pathlib.Path], compiler: str) -> bytes:
+    iquotes_options = _get_iquotes_options([iquote.resolve() for iquote in iquotes])
+    return _get_uncommented_code(path.resolve(), iquotes_options=iquotes_options, compiler=compiler)
+
+
+# ファイルの大きさより 1 byte 大きい buffer を先に確保して読み込む
+# ファイルの末尾に改行がなかったらその場で足すので、読み込んだ内容を連結し直さなくてよい
+def _read_source(path: pathlib.Path) -> bytes:
+    with open(str(path), 'rb', buffering=0) as fh:
+        buf = bytearray(os.fstat(fh.fileno()).st_size + 1)
+        n = 0
+        with memoryview(buf) as view:
+            while n < len(buf):
+                k = fh.readinto(view[n:])
+                if not k:
+                    break
+                n += k
+        if n == len(buf):
+            # stat した後でファイルが伸びた
+            buf += fh.read()
+            n = len(buf)
+    if n < len(buf):
+        if n == 0 or buf[n - 1] != 0x0A:
+            # 確保しておいた 1 byte に改行を書く
+            buf[n] = 0x0A
+            n += 1
+        del buf[n:]
+    elif buf[-1] != 0x0A:
+        buf += b'\n'
+    # bytearray のまま分割すると各行も bytearray になり、行ごとの処理が遅くなる
+    return bytes(buf)
 
 
 class BundleError(Exception):
@@ -150,178 +354,345 @@ class BundleErrorAt(BundleError):
         super().__init__(message, *args, **kwargs)  # type: ignore
 
 
+def _relative_to_cwd(path: pathlib.Path) -> pathlib.Path:
+    try:
+        return path.relative_to(pathlib.Path.cwd())
+    except ValueError:
+        return path
+
+
+class _Frame(object):
+    # Bundler.update で処理中のファイルの状態
+    path: pathlib.Path
+    key: str
+    lines: List[bytes]
+    uncommented_lines: List[bytes]
+    index: int  # 次に処理する行
+    resume_line: Optional[int]  # #include "..." から戻ってきたときに #line で指定する行番号
+    emit_start: int  # このファイルの出力の result_lines 中での開始位置
+
+    # include guard のまわりの変数
+    # NOTE: include guard に使われたマクロがそれ以外の用途にも使われたり #undef されたりすると壊れるけど、無視します
+    non_guard_line_found: bool
+    pragma_once_found: bool
+    include_guard_macro: Optional[str]
+    include_guard_define_found: bool
+    include_guard_endif_found: bool
+    preprocess_if_nest: int
+    include_found: bool
+
+    def __init__(self, *, path: pathlib.Path, key: str, lines: List[bytes], uncommented_lines: List[bytes], emit_start: int) -> None:
+        self.path = path
+        self.key = key
+        self.lines = lines
+        self.uncommented_lines = uncommented_lines
+        self.index = 0
+        self.resume_line = None
+        self.emit_start = emit_start
+        self.non_guard_line_found = False
+        self.pragma_once_found = False
+        self.include_guard_macro = None
+        self.include_guard_define_found = False
+        self.include_guard_endif_found = False
+        self.preprocess_if_nest = 0
+        self.include_found = False
+
+
 class Bundler(object):
     iquotes: List[pathlib.Path]
-    pragma_once: Set[pathlib.Path]
+    pragma_once: Set[str]
     pragma_once_system: Set[str]
-    result_lines: List[bytes]
-    path_stack: Set[pathlib.Path]
+    _bits_stdcxx_h_included: bool  # bits_stdcxx_h in pragma_once_system
+    result_lines: bytearray
+    _pending_line: Optional[bytes]  # まだ result_lines に書いていない #line
+    path_stack: Set[str]
     compiler: str
+    _resolve_cache: Dict[Tuple[str, str], Optional[pathlib.Path]]
+    _emit_cache: Dict[str, bytes]
+    _realpath_cache: Dict[pathlib.Path, pathlib.Path]
 
     def __init__(self, *, iquotes: List[pathlib.Path] = [], compiler: str = os.environ.get('CXX', 'g++')) -> None:
         self.iquotes = iquotes
         self.pragma_once = set()
         self.pragma_once_system = set()
-        self.result_lines = []
+        self._bits_stdcxx_h_included = False
+        self.result_lines = bytearray()
+        self._pending_line = None
         self.path_stack = set()
         self.compiler = compiler
+        self._resolve_cache = {}
+        self._emit_cache = {}
+        self._realpath_cache = {}
 
     # これをしないと __FILE__ や __LINE__ が壊れる
+    # 後ろに何も書かれない #line は不要なので、次に何かを書くまで保留しておき、その前にまた _line が呼ばれたら上書きする
     def _line(self, line: int, path: pathlib.Path) -> None:
-        while self.result_lines and self.result_lines[-1].startswith(b'#line '):
-            self.result_lines.pop()
-        try:
-            path = path.relative_to(pathlib.Path.cwd())
-        except ValueError:
-            pass
-        self.result_lines.append('#line {} "{}"\n'.format(line, str(path)).encode())
+        self._pending_line = '#line {} "{}"\n'.format(line, str(_relative_to_cwd(path))).encode()
+
+    def _flush_line(self) -> None:
+        if self._pending_line is not None:
+            self.result_lines += self._pending_line
+            self._pending_line = None
+
+    def _emit(self, data: bytes) -> None:
+        self._flush_line()
+        self.result_lines += data
+
+    # path.resolve() は毎回 syscall を呼ぶので覚えておく. bundle している間はファイルシステムは変化しないとみなす
+    def _realpath(self, path: pathlib.Path) -> pathlib.Path:
+        resolved = self._realpath_cache.get(path)
+        if resolved is None:
+            resolved = path.resolve()
+            self._realpath_cache[path] = resolved
+        return resolved
+
+    def _get_iquotes_options(self) -> Tuple[str, ...]:
+        return _get_iquotes_options([self._realpath(iquote) for iquote in self.iquotes])
 
     # path を解決する
-    # see: https://gcc.gnu.org/onlinedocs/gcc/Directory-Options.html#Directory-Options
+    # 同じ header は多くのファイルから #include されるので、結果 (見付からなかったことも含む) を覚えておく
     def _resolve(self, path: pathlib.Path, *, included_from: pathlib.Path) -> pathlib.Path:
+        key = (str(path), str(included_from.parent))
+        if key not in self._resolve_cache:
+            self._resolve_cache[key] = self._resolve_uncached(path, included_from=included_from)
+        resolved = self._resolve_cache[key]
+        if resolved is None:
+            raise BundleErrorAt(path, -1, "no such header")
+        return resolved
+
+    # see: https://gcc.gnu.org/onlinedocs/gcc/Directory-Options.html#Directory-Options
+    def _resolve_uncached(self, path: pathlib.Path, *, included_from: pathlib.Path) -> Optional[pathlib.Path]:
         if (included_from.parent / path).exists():
-            return (included_from.parent / path).resolve()
+            return self._realpath(included_from.parent / path)
         for dir_ in self.iquotes:
             if (dir_ / path).exists():
-                return (dir_ / path).resolve()
-        raise BundleErrorAt(path, -1, "no such header")
-
-    def update(self, path: pathlib.Path) -> None:
-        if path.resolve() in self.pragma_once:
-            logger.debug('%s: skipped since this file is included once with include guard', str(path))
+                return self._realpath(dir_ / path)
+        return None
+
+    # entry から #include "..." で辿れるファイルたちのコメントを、先にまとめて消しておく
+    # 失敗したファイルについては、実際にそのファイルを処理するときにエラーを報告する
+    def prewarm(self, entry: pathlib.Path) -> None:
+        iquotes_options = self._get_iquotes_options()
+        visited = set()  # type: Set[pathlib.Path]
+        paths = [self._realpath(entry)]
+        if str(paths[0]) in self.pragma_once:
             return
+        while paths:
+            visited.update(paths)
+            try:
+                _preprocess_many_files(paths, iquotes_options=iquotes_options, compiler=self.compiler)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.debug('failed to prewarm: %s', e)
+            included_paths = []
+            for path in paths:
+                uncommented = _uncommented_code_cache.get((path, iquotes_options, self.compiler))
+                if uncommented is None:
+                    continue
+                for matched in RE_INCLUDE_USER_MULTILINE.finditer(uncommented):
+                    try:
+                        included_path = self._resolve(pathlib.Path(matched.group(1).decode()), included_from=path)
+                    except BundleError:
+                        continue
+                    if included_path not in visited and str(included_path) not in self.pragma_once:
+                        included_paths.append(included_path)
+            paths = list(dict.fromkeys(included_paths))
+
+    # ファイルを読んで処理を始める準備をする. 処理する必要がなければ None を返す
+    # stack は処理中のファイルたちで、stack[-1] が path を #include している
+    def _open(self, path: pathlib.Path, *, stack: Sequence[_Frame] = ()) -> Optional[_Frame]:
+        # pragma_once や path_stack などでは、解決済みの path を文字列にしたものを使う
+        key = str(self._realpath(path))
+        if key in self.pragma_once:
+            logger.debug('%s: skipped since this file is included once with include guard', str(path))
+            return None
 
-        # 再帰的に自分自身を #include してたら諦める
-        if path in self.path_stack:
-            raise BundleErrorAt(path, -1, "cycle found in inclusion relations")
-        self.path_stack.add(path)
-        try:
-
-            with open(str(path), "rb") as fh:
-                code = fh.read()
-                if not code.endswith(b"\n"):
-                    # ファイルの末尾に改行がなかったら足す
-                    code += b"\n"
-
-            # include guard のまわりの変数
-            # NOTE: include guard に使われたマクロがそれ以外の用途にも使われたり #undef されたりすると壊れるけど、無視します
-            non_guard_line_found = False
-            pragma_once_found = False
-            include_guard_macro = None  # type: Optional[str]
-            include_guard_define_found = False
-            include_guard_endif_found = False
-            preprocess_if_nest = 0
-
-            lines = code.splitlines(keepends=True)
-            uncommented_lines = get_uncommented_code(path, iquotes=self.iquotes, compiler=self.compiler).splitlines(keepends=True)
-            uncommented_lines.extend([b''] * (len(lines) - len(uncommented_lines)))  # trailing comment lines are removed
-            assert len(lines) == len(uncommented_lines)
+        # include guard のないファイルが何度も #include されたときは、前回の結果を使い回す
+        if key in self._emit_cache:
+            logger.debug('%s: reused the result of the previous inclusion', str(path))
             self._line(1, path)
-            for i, (line, uncommented_line) in enumerate(zip(lines, uncommented_lines)):
+            cached = self._emit_cache[key]
+            if cached:
+                # 保存した出力は自分の #line から始まっている
+                self._pending_line = None
+                self.result_lines += cached
+            return None
 
+        # 再帰的に自分自身を #include してたら諦める
+        # g++ には #include を展開させていないので、循環の検出はここで path_stack を見るしかない
+        if key in self.path_stack:
+            # 循環している部分を、それを閉じる #include の位置と一緒に報告する
+            cycle = [frame.path for frame in stack[[frame.key for frame in stack].index(key):]] + [path]
+            raise BundleErrorAt(stack[-1].path, stack[-1].index, "cycle found in inclusion relations: " + ' -> '.join(str(_relative_to_cwd(cycle_path)) for cycle_path in cycle))
+
+        code = _read_source(path)
+        uncommented = _get_uncommented_code(self._realpath(path), iquotes_options=self._get_iquotes_options(), compiler=self.compiler)
+        lines = code.splitlines(keepends=True)
+        # コメントを含まないファイルでは同じものになるので、2 回分割しなくてよい
+        uncommented_lines = lines if uncommented == code else uncommented.splitlines(keepends=True)
+        uncommented_lines.extend([b''] * (len(lines) - len(uncommented_lines)))  # trailing comment lines are removed
+        assert len(lines) == len(uncommented_lines)
+
+        self.path_stack.add(key)
+        self._line(1, path)
+        return _Frame(path=path, key=key, lines=lines, uncommented_lines=uncommented_lines, emit_start=len(self.result_lines))
+
+    # frame.index 行目から処理を進める. #include "..." が見付かればそこで止めて、その path を返す
+    def _process(self, frame: _Frame) -> Optional[pathlib.Path]:
+        path = frame.path
+        if frame.resume_line is not None:
+            self._line(frame.resume_line, path)
+            frame.resume_line = None
+
+        # 毎行使うものは local 変数に入れておく
+        lines = frame.lines
+        uncommented_lines = frame.uncommented_lines
+        result_lines = self.result_lines
+        for i in range(frame.index, len(lines)):
+            line = lines[i]
+            uncommented_line = uncommented_lines[i]
+
+            # ほとんどの行は directive ではないので、正規表現を試す前に先頭の文字だけで判定して弾く
+            # #pragma once は uncommented_line からは消えているので line の方も見る
+            is_directive = uncommented_line.lstrip()[:1] == b'#' or (line is not uncommented_line and line.lstrip()[:1] == b'#')
+            if is_directive:
                 # nest の処理
-                if re.match(rb'\s*#\s*(if|ifdef|ifndef)\s.*', uncommented_line):
-                    preprocess_if_nest += 1
-                if re.match(rb'\s*#\s*(else\s*|elif\s.*)', uncommented_line):
-                    if preprocess_if_nest == 0:
+                directive, argument = classify(uncommented_line)
+                if directive in ('if', 'ifdef', 'ifndef'):
+                    frame.preprocess_if_nest += 1
+                elif directive in ('else', 'elif'):
+                    if frame.preprocess_if_nest == 0:
                         raise BundleErrorAt(path, i + 1, "unmatched #else / #elif")
-                if re.match(rb'\s*#\s*endif\s*', uncommented_line):
-                    preprocess_if_nest -= 1
-                    if preprocess_if_nest < 0:
+                elif directive == 'endif':
+                    frame.preprocess_if_nest -= 1
+                    if frame.preprocess_if_nest < 0:
                         raise BundleErrorAt(path, i + 1, "unmatched #endif")
-                is_toplevel = preprocess_if_nest == 0 or (preprocess_if_nest == 1 and include_guard_macro is not None)
+                is_toplevel = frame.preprocess_if_nest == 0 or (frame.preprocess_if_nest == 1 and frame.include_guard_macro is not None)
 
                 # #pragma once
-                if re.match(rb'\s*#\s*pragma\s+once\s*', line):  # #pragma once は comment 扱いで消されてしまう
+                # #pragma once は g++ には comment 扱いで消されてしまうので、元の行を見る. #include <...> などはそのままなので見直さなくてよい
+                if directive is None or directive == 'pragma':
+                    raw_directive, raw_argument = classify(line)
+                else:
+                    raw_directive, raw_argument = directive, argument
+                if raw_directive == 'pragma' and RE_PRAGMA_ONCE_ARGUMENT.match(raw_argument):
                     logger.debug('%s: line %s: #pragma once', str(path), i + 1)
-                    if non_guard_line_found:
+                    if frame.non_guard_line_found:
                         # 先頭以外で #pragma once されてた場合は諦める
                         raise BundleErrorAt(path, i + 1, "#pragma once found in a non-first line")
-                    if include_guard_macro is not None:
+                    if frame.include_guard_macro is not None:
                         raise BundleErrorAt(path, i + 1, "#pragma once found in an include guard with #ifndef")
-                    if path.resolve() in self.pragma_once:
-                        return
-                    pragma_once_found = True
-                    self.pragma_once.add(path.resolve())
+                    if frame.key in self.pragma_once:
+                        return None
+                    frame.pragma_once_found = True
+                    self.pragma_once.add(frame.key)
                     self._line(i + 2, path)
                     continue
 
                 # #ifndef HOGE_H as guard
-                if not pragma_once_found and not non_guard_line_found and include_guard_macro is None:
-                    matched = re.match(rb'\s*#\s*ifndef\s+(\w+)\s*', uncommented_line)
+                if not frame.pragma_once_found and not frame.non_guard_line_found and frame.include_guard_macro is None and directive == 'ifndef':
+                    matched = RE_MACRO_ARGUMENT.match(argument)
                     if matched:
-                        include_guard_macro = matched.group(1).decode()
-                        logger.debug('%s: line %s: #ifndef %s', str(path), i + 1, include_guard_macro)
-                        self.result_lines.append(b"\n")
+                        frame.include_guard_macro = matched.group(1).decode()
+                        logger.debug('%s: line %s: #ifndef %s', str(path), i + 1, frame.include_guard_macro)
+                        self._emit(b"\n")
                         continue
 
                 # #define HOGE_H as guard
-                if include_guard_macro is not None and not include_guard_define_found:
-                    matched = re.match(rb'\s*#\s*define\s+(\w+)\s*', uncommented_line)
-                    if matched and matched.group(1).decode() == include_guard_macro:
-                        self.pragma_once.add(path.resolve())
-                        logger.debug('%s: line %s: #define %s', str(path), i + 1, include_guard_macro)
-                        include_guard_define_found = True
-                        self.result_lines.append(b"\n")
+                if frame.include_guard_macro is not None and not frame.include_guard_define_found and directive == 'define':
+                    matched = RE_MACRO_ARGUMENT.match(argument)
+                    if matched and matched.group(1).decode() == frame.include_guard_macro:
+                        self.pragma_once.add(frame.key)
+                        logger.debug('%s: line %s: #define %s', str(path), i + 1, frame.include_guard_macro)
+                        frame.include_guard_define_found = True
+                        self._emit(b"\n")
                         continue
 
                 # #endif as guard
-                if include_guard_define_found and preprocess_if_nest == 0 and not include_guard_endif_found:
-                    if re.match(rb'\s*#\s*endif\s*', uncommented_line):
-                        include_guard_endif_found = True
-                        self.result_lines.append(b"\n")
+                if frame.include_guard_define_found and frame.preprocess_if_nest == 0 and not frame.include_guard_endif_found:
+                    if directive == 'endif':
+                        frame.include_guard_endif_found = True
+                        self._emit(b"\n")
                         continue
 
-                if uncommented_line:
-                    non_guard_line_found = True
-                    if include_guard_macro is not None and not include_guard_define_found:
-                        # 先頭に #ifndef が見付かっても #define が続かないならそれは include guard ではない
-                        include_guard_macro = None
-                    if include_guard_endif_found:
-                        # include guard の外側にコードが書かれているとまずいので検出する
-                        raise BundleErrorAt(path, i + 1, "found codes out of include guard")
-
-                # #include <...>
-                matched = re.match(rb'\s*#\s*include\s*<(.*)>\s*', uncommented_line)
+            if uncommented_line:
+                frame.non_guard_line_found = True
+                if frame.include_guard_macro is not None and not frame.include_guard_define_found:
+                    # 先頭に #ifndef が見付かっても #define が続かないならそれは include guard ではない
+                    frame.include_guard_macro = None
+                if frame.include_guard_endif_found:
+                    # include guard の外側にコードが書かれているとまずいので検出する
+                    raise BundleErrorAt(path, i + 1, "found codes out of include guard")
+
+            if is_directive:
+                # #include <...> / #include "..."
+                matched = RE_INCLUDE_ARGUMENT.match(argument) if directive == 'include' else None
                 if matched:
-                    included = matched.group(1).decode()
+                    frame.include_found = True
+                if matched and matched.group('system') is not None:
+                    included = matched.group('system').decode()
                     logger.debug('%s: line %s: #include <%s>', str(path), i + 1, str(included))
-                    if included in self.pragma_once_system or bits_stdcxx_h in self.pragma_once_system:
+                    if self._bits_stdcxx_h_included or included in self.pragma_once_system:
                         self._line(i + 2, path)
                     elif is_toplevel and included in standard_libraries:
                         self.pragma_once_system.add(included)
-                        self.result_lines.append(line)
+                        if included == bits_stdcxx_h:
+                            self._bits_stdcxx_h_included = True
+                        self._emit(line)
                     else:
                         # #pragma once 系の判断ができない場合はそっとしておく
-                        self.result_lines.append(line)
+                        self._emit(line)
                     continue
-
-                # #include "..."
-                matched = re.match(rb'\s*#\s*include\s*"(.*)"\s*', uncommented_line)
                 if matched:
-                    included = matched.group(1).decode()
+                    included = matched.group('user').decode()
                     logger.debug('%s: line %s: #include "%s"', str(path), i + 1, included)
                     if not is_toplevel:
                         # #if の中から #include されると #pragma once 系の判断が不可能になるので諦める
                         raise BundleErrorAt(path, i + 1, "unable to process #include in #if / #ifdef / #ifndef other than include guards")
-                    self.update(self._resolve(pathlib.Path(included), included_from=path))
-                    self._line(i + 2, path)
+                    # #include されたファイルを処理し終えたら、次の行から再開する
+                    frame.index = i + 1
+                    frame.resume_line = i + 2
                     # TODO: #include "iostream" みたいに書いたときの挙動をはっきりさせる
                     # TODO: #include <iostream> /* とかをやられた場合を落とす
-                    continue
+                    return self._resolve(pathlib.Path(included), included_from=path)
+
+            # otherwise
+            if self._pending_line is not None:
+                self._flush_line()
+            result_lines += line
+
+        # #if #endif の対応が壊れてたら諦める
+        if frame.preprocess_if_nest != 0:
+            raise BundleErrorAt(path, len(lines), "unmatched #if / #ifdef / #ifndef")
+        if frame.include_guard_macro is not None and not frame.include_guard_endif_found:
+            raise BundleErrorAt(path, len(lines), "unmatched #ifndef")
 
-                # otherwise
-                self.result_lines.append(line)
+        # 他のファイルを #include していなければ、何度処理しても同じ結果になる
+        if not frame.include_found and frame.key not in self.pragma_once:
+            self._emit_cache[frame.key] = bytes(self.result_lines[frame.emit_start:])
+        return None
 
-            # #if #endif の対応が壊れてたら諦める
-            if preprocess_if_nest != 0:
-                raise BundleErrorAt(path, i + 1, "unmatched #if / #ifdef / #ifndef")
-            if include_guard_macro is not None and not include_guard_endif_found:
-                raise BundleErrorAt(path, i + 1, "unmatched #ifndef")
+    def update(self, path: pathlib.Path) -> None:
+        self.prewarm(path)
 
+        # #include のたびに再帰呼び出しをする代わりに、処理中のファイルを stack に積む
+        frame = self._open(path)
+        if frame is None:
+            return
+        stack = [frame]
+        try:
+            while stack:
+                included = self._process(stack[-1])
+                if included is not None:
+                    child = self._open(included, stack=stack)
+                    if child is not None:
+                        stack.append(child)
+                else:
+                    self.path_stack.remove(stack.pop().key)
+            self._flush_line()
         finally:
-            # 中で return することがあるので finally 節に入れておく
-            self.path_stack.remove(path)
+            # 途中で失敗した場合
+            for frame in stack:
+                self.path_stack.remove(frame.key)
 
     def get(self) -> bytes:
-        return b''.join(self.result_lines)
+        return bytes(self.result_lines)
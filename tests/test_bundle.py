@@ -8,6 +8,13 @@ import onlinejudge_verify.languages.cplusplus_bundle as cplusplus_bundle
 import tests.utils
 from onlinejudge_verify.languages.cplusplus_bundle import BundleError
 
+# 閉じていない ' があると strip_comments では処理できず g++ が使われる
+GCC_FALLBACK_FILES = {
+    'foo.hpp': b"#pragma once\n#error don't include this file  // foo\n",
+    'bar.hpp': b"/* bar\n */\n#error don't include this file\n",
+    'baz.hpp': b"#error don't include this file",
+}
+
 
 @unittest.skipIf(platform.system() == 'Darwin', 'We cannot use the fake g++ of macOS.')
 class TestStringMethods(unittest.TestCase):
@@ -66,3 +73,160 @@ class TestStringMethods(unittest.TestCase):
             with tests.utils.chdir(tempdir):
                 bundler = cplusplus_bundle.Bundler(iquotes=[tempdir], compiler='clang++')
                 self.assertRaises(BundleError, lambda: bundler.update(path))
+
+    def test_strip_comments(self) -> None:
+        # コメントのように見える文字列リテラルなどを消さず、行数を保つことの確認
+
+        code = textwrap.dedent("""\
+            #include "foo.hpp"  // comment
+            /* #include "bar.hpp"
+            */ int a = 1'000'000;
+            const char *s = "/* not a comment */", c = '"';
+            const char *t = R"(// not a comment)";
+            """).encode()
+        expected = b''.join([
+            b'#include "foo.hpp"  \n',
+            b'\n',
+            b" int a = 1'000'000;\n",
+            b'const char *s = "/* not a comment */", c = \'"\';\n',
+            b'const char *t = R"(// not a comment)";\n',
+        ])
+        self.assertEqual(cplusplus_bundle.strip_comments(code), expected)
+
+    def test_preprocess_many_files(self) -> None:
+        # Bundler.prewarm でまとめて g++ に通した結果がファイルごとに通した結果と一致することの確認
+
+        files = {
+            **GCC_FALLBACK_FILES,
+            'example.test.cpp': b'#include "foo.hpp"\n#include "bar.hpp"\n#include "baz.hpp"\n',
+        }
+        with tests.utils.load_files(files) as tempdir:
+            with tests.utils.chdir(tempdir):
+                paths = [tempdir / name for name in GCC_FALLBACK_FILES]
+                cplusplus_bundle.Bundler(iquotes=[tempdir], compiler='g++').prewarm(pathlib.Path('example.test.cpp'))
+                batched = [cplusplus_bundle.get_uncommented_code(path, iquotes=[tempdir], compiler='g++') for path in paths]
+                cplusplus_bundle.clear_caches()
+                expected = [cplusplus_bundle.get_uncommented_code(path, iquotes=[tempdir], compiler='g++') for path in paths]
+                self.assertEqual(batched, expected)
+
+    def test_run_gcc_at_once(self) -> None:
+        # 1 回の g++ の出力をファイルごとに分けた結果が、ファイルごとに g++ に通した結果と一致することの確認
+
+        with tests.utils.load_files(GCC_FALLBACK_FILES) as tempdir:
+            with tests.utils.chdir(tempdir):
+                paths = [tempdir / name for name in GCC_FALLBACK_FILES]
+                iquotes_options = cplusplus_bundle._get_iquotes_options([tempdir])
+                batched = cplusplus_bundle._run_gcc_at_once(paths, iquotes_options=iquotes_options, compiler='g++')
+                for path in paths:
+                    expected = cplusplus_bundle._run_gcc_at_once([path], iquotes_options=iquotes_options, compiler='g++')
+                    self.assertEqual(batched[path], expected[path])
+
+    @unittest.skipIf(platform.system() == 'Windows', 'We cannot use " or \\ in file names on Windows.')
+    def test_run_gcc_at_once_escaped_path(self) -> None:
+        # g++ が line marker の中で escape する \ や " を含む path でも、出力をファイルごとに分けられることの確認
+
+        with tests.utils.load_files({}) as tempdir:
+            with tests.utils.chdir(tempdir):
+                paths = [tempdir / 'back\\slash.hpp', tempdir / 'double"quote.hpp']
+                for path in paths:
+                    path.write_bytes(b"#error don't include this file\n")
+                iquotes_options = cplusplus_bundle._get_iquotes_options([tempdir])
+                batched = cplusplus_bundle._run_gcc_at_once(paths, iquotes_options=iquotes_options, compiler='g++')
+                self.assertEqual(batched, {path: b"#error don't include this file\n" for path in paths})
+
+    def test_if_without_space(self) -> None:
+        # #if(...) のように空白を挟まない directive も #if として数えることの確認
+
+        files = {
+            'example.test.cpp': textwrap.dedent("""\
+                #if(1)
+                int a;
+                #elif(0)
+                int b;
+                #endif
+                """).encode(),
+        }
+        path = pathlib.Path('example.test.cpp')
+        with tests.utils.load_files(files) as tempdir:
+            with tests.utils.chdir(tempdir):
+                bundler = cplusplus_bundle.Bundler(iquotes=[tempdir])
+                bundler.update(path)
+                self.assertIn(b'int a;\n', bundler.get())
+
+    def test_cycle(self) -> None:
+        # 循環している #include を、それを閉じる #include の行で報告することの確認
+
+        files = {
+            'a.hpp': b'#include "b.hpp"\n',
+            'b.hpp': b'int b;\n#include "a.hpp"\n',
+            'example.test.cpp': b'#include "a.hpp"\n',
+        }
+        path = pathlib.Path('example.test.cpp')
+        with tests.utils.load_files(files) as tempdir:
+            with tests.utils.chdir(tempdir):
+                bundler = cplusplus_bundle.Bundler(iquotes=[tempdir])
+                with self.assertRaisesRegex(BundleError, r'^b\.hpp: line 2: cycle found in inclusion relations: a\.hpp -> b\.hpp -> a\.hpp$'):
+                    bundler.update(path)
+
+    def test_include_unguarded_twice(self) -> None:
+        # include guard のないファイルを何度も #include したときに、毎回同じ内容が #line 付きで展開されることの確認
+
+        files = {
+            'unguarded.hpp': b'int x;\nint y;\n',
+            'example.test.cpp': textwrap.dedent("""\
+                #include "unguarded.hpp"
+                int a;
+                #include "unguarded.hpp"
+                #include "unguarded.hpp"
+                int b;
+                """).encode(),
+        }
+        expected = b''.join([
+            b'#line 1 "unguarded.hpp"\n',
+            b'int x;\n',
+            b'int y;\n',
+            b'#line 2 "example.test.cpp"\n',
+            b'int a;\n',
+            b'#line 1 "unguarded.hpp"\n',
+            b'int x;\n',
+            b'int y;\n',
+            b'#line 1 "unguarded.hpp"\n',
+            b'int x;\n',
+            b'int y;\n',
+            b'#line 5 "example.test.cpp"\n',
+            b'int b;\n',
+        ])
+        path = pathlib.Path('example.test.cpp')
+        with tests.utils.load_files(files) as tempdir:
+            with tests.utils.chdir(tempdir):
+                bundler = cplusplus_bundle.Bundler(iquotes=[tempdir])
+                bundler.update(path)
+                self.assertEqual(bundler.get(), expected)
+
+    def test_keep_user_line_directive(self) -> None:
+        # ユーザが書いた #line は、直後に #include があっても消さずに残すことの確認
+
+        files = {
+            'a.hpp': b'int x;\n',
+            'example.test.cpp': textwrap.dedent("""\
+                int a;
+                #line 100
+                #include "a.hpp"
+                int b;
+                """).encode(),
+        }
+        expected = b''.join([
+            b'#line 1 "example.test.cpp"\n',
+            b'int a;\n',
+            b'#line 100\n',
+            b'#line 1 "a.hpp"\n',
+            b'int x;\n',
+            b'#line 4 "example.test.cpp"\n',
+            b'int b;\n',
+        ])
+        path = pathlib.Path('example.test.cpp')
+        with tests.utils.load_files(files) as tempdir:
+            with tests.utils.chdir(tempdir):
+                bundler = cplusplus_bundle.Bundler(iquotes=[tempdir])
+                bundler.update(path)
+                self.assertEqual(bundler.get(), expected)